@@ -5,7 +5,12 @@ import subprocess
 import platform
 from typing import Dict, Union
 
-from src.instance import load_instance_data, Instance, load_all_instances
+from src.instance import load_instance_data, Instance, load_all_instances, regenerate_nginx_configs, SIZE_CLASSES
+from src.analytics import analyze_instances, parse_since
+from src.metrics import collect_metrics, serve_metrics
+from src.pgbouncer import print_pool_report
+from src.transfer import export_instance, import_instance, check_exportable, get_release_source, open_output, open_input
+from src.fleet import load_spec, compute_plan, print_plan, apply_plan
 
 ROOT = '/opt/odoo/'
 PYTHON_DEPENDENCIES = [
@@ -48,25 +53,99 @@ Create Instance (create):
     -ot: Odoo template (optional)
     -st: Service template (optional)
     -nt: Nginx template (optional)
+    -w: Wait for the instance to be ready and warm it up (optional)
+    -pb: Connect to PostgreSQL through a local pgbouncer (optional)
+    --class: Size class (small, medium, large, xlarge) for hard resource limits, fair share only by default [optional]
     e.g. create -v 16.0 -p 8069 -l 8072 -n odoo-16 
     e.g. create -v 16.0 -p 8069 -l 8072 -n odoo-16 -s odoo-16.example.com -ot odoo-16.conf -st odoo-16.service -nt odoo-16.nginx
+    e.g. create -v 16.0 -p 8069 -l 8072 -n odoo-16 -nt nginx_performance.conf
 
 Reset Instance (reset):
     -i: Instance name [required]
     -t: Type (e.g., odoo, nginx, service) [required]
+    -w: Wait for the instance to be ready and warm it up (optional)
+    -r: Rolling restart without downtime through a temporary process (optional)
     e.g. reset -i instance_name
 
 Update Instance (update):
     -i: Instance name [required]
     -d: Odoo date (e.g., 20211010) [optional]
+    -w: Wait for the instance to be ready and warm it up (optional)
+    -r: Rolling restart without downtime through a temporary process (optional)
     e.g. update -i instance_name
     e.g. update -i instance_name -d 20211010
 
 Add Dependency (add_dependency):
     -i: Instance name [required]
     -d: Dependency name [required]
+    -w: Wait for the instance to be ready and warm it up (optional)
+    -r: Rolling restart without downtime through a temporary process (optional)
     e.g. add_dependency -i instance_name -d Babel
 
+Warm Up Instance (warmup):
+    -i: Instance name [required]
+    -r: Comma separated warm-up routes to save (optional)
+    e.g. warmup -i instance_name
+    e.g. warmup -i instance_name -r /web/login,/shop
+    Requests carry the server name as Host. Only anonymous pages are warmed, the backend
+    bundle is compiled by the first backend load after a restart.
+
+Regenerate Nginx Sites (regenerate_nginx):
+    -nt: Nginx template to switch every instance to (optional)
+    e.g. regenerate_nginx
+    e.g. regenerate_nginx -nt nginx_performance.conf
+
+Analyze Access Logs (analyze):
+    -i: Instance name [required unless -a]
+    -a: Analyze all instances (optional)
+    --since: Relative (30m, 24h, 7d, 2w) or ISO date (e.g., 2024-01-31) [optional]
+    -r: Resume from the position saved by the previous run (optional)
+    -t: Number of slowest endpoints to show (default 10) [optional]
+    e.g. analyze -i instance_name --since 24h
+    e.g. analyze -a -r
+
+Metrics (metrics):
+    -s: Serve the metrics over HTTP on this port instead of printing them (optional)
+    -b: Address to bind the HTTP server to (default 127.0.0.1) [optional]
+    e.g. metrics
+    e.g. metrics -s 9100 -b 0.0.0.0
+
+PgBouncer (pgbouncer):
+    -i: Instance name [required with -e or -d]
+    -e: Connect the instance to PostgreSQL through pgbouncer (optional)
+    -d: Connect the instance directly to PostgreSQL (optional)
+    -r: Show the pool saturation of every instance using pgbouncer (optional)
+    e.g. pgbouncer -i instance_name -e
+    e.g. pgbouncer -r
+
+Resize Instance (resize):
+    -i: Instance name [required]
+    --class: Size class (small, medium, large, xlarge), or none to remove the hard limits [required]
+    e.g. resize -i instance_name --class large
+
+Export Instance (export):
+    -i: Instance name [required]
+    -o: Output file, - for stdout [required]
+    -ns: Do not include a dated Odoo release, the target downloads it if not cached (optional)
+         Latest releases are always included, the export fails if the build cannot be found
+    -j: Number of databases dumped in parallel (default: number of cpus) [optional]
+    e.g. export -i instance_name -o instance_name.tar
+    e.g. export -i instance_name -o - | ssh target sudo odoo-server-manager import -f -
+
+Import Instance (import):
+    -f: Archive file, - for stdin [required]
+    e.g. import -f instance_name.tar
+
+Apply Fleet Spec (apply):
+    -f: Spec file (YAML, or JSON for .json files) [required]
+    --dry-run: Only show the plan (optional)
+    -j: Number of parallel jobs (optional)
+    -w: Wait for the instances to be ready and warm them up (optional)
+    --confirm-delete: Required to run a plan deleting instances (prune) (optional)
+    e.g. apply -f fleet.yaml --dry-run
+    e.g. apply -f fleet.yaml -j 4
+    e.g. apply -f fleet.yaml --confirm-delete
+
 Delete Instance (delete):
     -n: Instance name [required]
     e.g. delete -n instance_name
@@ -119,10 +198,11 @@ def find_args(
         required = arg_rules.get('required', False)
         type_ = arg_rules.get('type', 'str')
 
+        # Arguments start and end on whitespace, so -r does not match inside a value like django-redis
         if value:
-            pattern = f'{prefix}{arg_name}\\s+([^\\s]+)'
+            pattern = f'(?:^|\\s){prefix}{arg_name}\\s+([^\\s]+)'
         else:
-            pattern = f'{prefix}{arg_name}'
+            pattern = f'(?:^|\\s){prefix}{arg_name}(?=\\s|$)'
 
         match = re.search(pattern, input_string, re.IGNORECASE)
         if match:
@@ -213,7 +293,7 @@ def _install_wkhtmltopdf():
 
 
 if __name__ == "__main__":
-    error = "Please provide an operation (list, create, update, add_dependency, delete, add_user, journal, help)"
+    error = "Please provide an operation (list, create, update, add_dependency, warmup, regenerate_nginx, analyze, metrics, pgbouncer, resize, export, import, apply, delete, add_user, journal, help)"
     if not os.path.exists("/opt/odoo"):
         subprocess.run(["sudo", "mkdir", "/opt/odoo"])
     if len(sys.argv) < 2:
@@ -243,6 +323,9 @@ if __name__ == "__main__":
             'ot': {'value': True, 'required': False, 'type': 'str'},
             'st': {'value': True, 'required': False, 'type': 'str'},
             'nt': {'value': True, 'required': False, 'type': 'str'},
+            'w': {'value': False},
+            'pb': {'value': False},
+            'class': {'prefix': '--', 'value': True, 'required': False, 'type': 'str'},
         })
         if 'v' not in args or 'p' not in args or 'l' not in args:
             print("Please provide an odoo_version, a port and a longpolling_port")
@@ -250,6 +333,9 @@ if __name__ == "__main__":
         if args['v'] not in ["15.0", "16.0", "17.0"]:
             print("Please provide a valid odoo_version (15.0, 16.0, 17.0)")
             sys.exit(1)
+        if args.get('class') and args['class'] not in SIZE_CLASSES:
+            print(f"Please provide a valid size class ({', '.join(SIZE_CLASSES)})")
+            sys.exit(1)
         _install_odoo_dependencies()
         _install_wkhtmltopdf()
         instance = Instance(
@@ -262,11 +348,16 @@ if __name__ == "__main__":
             odoo_template=args['ot'] if 'ot' in args else 'odoo.conf',
             service_template=args['st'] if 'st' in args else 'service.conf',
             nginx_template=args['nt'] if 'nt' in args else 'nginx.conf',
+            wait_ready='w' in args,
+            pgbouncer='pb' in args,
+            size=args.get('class'),
         )
     elif operation == "reset":
         args = find_args(" ".join(sys.argv[2:]), {
             'i': {'value': True, 'required': True, 'type': 'str'},
             't': {'value': True, 'required': True, 'type': 'str'},
+            'w': {'value': False},
+            'r': {'value': False},
         })
         if args['t'] not in ["odoo", "nginx", "service"]:
             print("Please provide a valid type (odoo, nginx, service)")
@@ -276,11 +367,13 @@ if __name__ == "__main__":
             print("Instance not found")
             sys.exit(1)
         instance.reset(args['t'])
-        instance.restart()
+        instance.restart('w' in args, 'r' in args)
     elif operation == "update":
         args = find_args(" ".join(sys.argv[2:]), {
             'i': {'value': True, 'required': True, 'type': 'str'},
             'd': {'value': True, 'required': False, 'type': 'str'},
+            'w': {'value': False},
+            'r': {'value': False},
         })
         instance = load_instance_data(args['i'])
         if not instance:
@@ -289,18 +382,151 @@ if __name__ == "__main__":
         if args['d']:
             instance.odoo_date = args['d']
         instance.update_odoo_code()
-        instance.restart()
+        instance.restart('w' in args, 'r' in args)
     elif operation == "add_dependency":
         args = find_args(" ".join(sys.argv[2:]), {
             'i': {'value': True, 'required': True, 'type': 'str'},
             'd': {'value': True, 'required': True, 'type': 'str'},
+            'w': {'value': False},
+            'r': {'value': False},
         })
         instance = load_instance_data(args['i'])
         if not instance:
             print("Instance not found")
             sys.exit(1)
         instance.add_dependency(args['d'])
-        instance.restart()
+        instance.restart('w' in args, 'r' in args)
+    elif operation == "warmup":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'i': {'value': True, 'required': True, 'type': 'str'},
+            'r': {'value': True, 'required': False, 'type': 'str'},
+        })
+        instance = load_instance_data(args['i'])
+        if not instance:
+            print("Instance not found")
+            sys.exit(1)
+        if 'r' in args:
+            instance.warmup_routes = [route.strip() for route in args['r'].split(",") if route.strip()]
+            instance.save()
+        if instance.wait_until_ready():
+            instance.warm_up()
+        else:
+            print("Instance is not ready")
+            sys.exit(1)
+    elif operation == "regenerate_nginx":
+        args = find_args(" ".join(sys.argv[2:]), {'nt': {'value': True, 'required': False, 'type': 'str'}})
+        if not regenerate_nginx_configs(args['nt'] if 'nt' in args else None):
+            sys.exit(1)
+    elif operation == "analyze":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'i': {'value': True, 'required': False, 'type': 'str'},
+            'a': {'value': False},
+            'since': {'prefix': '--', 'value': True, 'required': False, 'type': 'str'},
+            'r': {'value': False},
+            't': {'value': True, 'required': False, 'type': 'int'},
+        })
+        if 'a' in args:
+            instances = load_all_instances()
+        elif 'i' in args:
+            instance = load_instance_data(args['i'])
+            if not instance:
+                print("Instance not found")
+                sys.exit(1)
+            instances = [instance]
+        else:
+            print("Please provide an instance name or -a")
+            sys.exit(1)
+        analyze_instances(instances, parse_since(args.get('since')), 'r' in args, args.get('t', 10))
+    elif operation == "metrics":
+        args = find_args(" ".join(sys.argv[2:]), {
+            's': {'value': True, 'required': False, 'type': 'int'},
+            'b': {'value': True, 'required': False, 'type': 'str'},
+        })
+        if 's' in args:
+            serve_metrics(load_all_instances, args['s'], args.get('b', '127.0.0.1'))
+        else:
+            print(collect_metrics(load_all_instances()), end="")
+    elif operation == "pgbouncer":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'i': {'value': True, 'required': False, 'type': 'str'},
+            'e': {'value': False},
+            'd': {'value': False},
+            'r': {'value': False},
+        })
+        if 'e' in args or 'd' in args:
+            instance = load_instance_data(args['i']) if 'i' in args else None
+            if not instance:
+                print("Instance not found")
+                sys.exit(1)
+            if 'e' in args:
+                instance.enable_pgbouncer()
+            else:
+                instance.disable_pgbouncer()
+            instance.restart()
+        if 'r' in args:
+            print_pool_report(load_all_instances())
+    elif operation == "resize":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'i': {'value': True, 'required': True, 'type': 'str'},
+            'class': {'prefix': '--', 'value': True, 'required': True, 'type': 'str'},
+        })
+        if args['class'] != 'none' and args['class'] not in SIZE_CLASSES:
+            print(f"Please provide a valid size class ({', '.join(SIZE_CLASSES)}) or none")
+            sys.exit(1)
+        instance = load_instance_data(args['i'])
+        if not instance:
+            print("Instance not found")
+            sys.exit(1)
+        instance.resize(None if args['class'] == 'none' else args['class'])
+    elif operation == "export":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'i': {'value': True, 'required': True, 'type': 'str'},
+            'o': {'value': True, 'required': True, 'type': 'str'},
+            'ns': {'value': False},
+            'j': {'value': True, 'required': False, 'type': 'int'},
+        })
+        instance = load_instance_data(args['i'])
+        if not instance:
+            print("Instance not found", file=sys.stderr)
+            sys.exit(1)
+        try:
+            check_exportable(instance)
+            release_path = get_release_source(instance, 'ns' not in args)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        with open_output(args['o']) as output:
+            export_instance(instance, output, args.get('j'), release_path)
+    elif operation == "import":
+        args = find_args(" ".join(sys.argv[2:]), {'f': {'value': True, 'required': True, 'type': 'str'}})
+        try:
+            import_instance(open_input(args['f']))
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    elif operation == "apply":
+        args = find_args(" ".join(sys.argv[2:]), {
+            'f': {'value': True, 'required': True, 'type': 'str'},
+            'dry-run': {'prefix': '--', 'value': False},
+            'j': {'value': True, 'required': False, 'type': 'int'},
+            'w': {'value': False},
+            'confirm-delete': {'prefix': '--', 'value': False},
+        })
+        try:
+            plan = compute_plan(load_spec(args['f']))
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print_plan(plan)
+        deletes = [action['name'] for action in plan if action['action'] == 'delete']
+        if deletes and 'dry-run' not in args and 'confirm-delete' not in args:
+            print(f"The plan deletes {', '.join(deletes)} with their databases, check it with --dry-run then run again with --confirm-delete")
+            sys.exit(1)
+        if 'dry-run' not in args:
+            def install_host_dependencies():
+                _install_odoo_dependencies()
+                _install_wkhtmltopdf()
+            apply_plan(plan, args.get('j'), 'w' in args, install_host_dependencies)
     elif operation == "delete":
         args = find_args(" ".join(sys.argv[2:]), {'i': {'value': True, 'required': True, 'type': 'str'}})
         print("Deleting instance...")
@@ -0,0 +1,262 @@
+import os
+import re
+import glob
+import gzip
+import math
+import pickle
+import datetime
+from collections import Counter
+
+from src.utils import Bcolors
+
+ROOT = '/opt/odoo/'
+NGINX_LOG_ROOT = '/var/log/nginx/'
+MAX_ROUTES = 5000
+
+LINE_PATTERN = re.compile(rb'^\S+ \S+ \S+ \[([^\]]+)\] "(\S+) (\S+)[^"]*" (\d{3}) (\d+|-)')
+REQUEST_TIME_PATTERN = re.compile(rb' rt=([\d.]+)')
+ID_SEGMENT_PATTERN = re.compile(r'^(\d+|\d+-[0-9a-f]+|[0-9a-f]{16,}|[\w.]+,\d+)$')
+SLUG_SEGMENT_PATTERN = re.compile(r'^.+-\d+$')
+RELATIVE_SINCE_PATTERN = re.compile(r'^(\d+)([mhdw])$')
+RELATIVE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+
+class LatencySketch:
+    """ Log-bucketed histogram giving quantiles within ~2% with bounded memory """
+
+    GAMMA = 1.04
+    MIN_VALUE = 0.0001
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = math.ceil(math.log(max(value, self.MIN_VALUE)) / math.log(self.GAMMA))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(2 * self.GAMMA ** index / (self.GAMMA + 1), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class LogStats:
+    """ Streaming statistics of an nginx access log """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+        self.statuses = Counter()
+        self.latency = LatencySketch()
+        self.routes = {}
+        # Resume position: inode and offset of the last complete line read
+        self.inode = None
+        self.offset = 0
+
+    def add(self, when, method, path, status, size, request_time):
+        self.requests += 1
+        self.bytes += size
+        if self.first is None or when < self.first:
+            self.first = when
+        if self.last is None or when > self.last:
+            self.last = when
+        self.statuses[status] += 1
+        if request_time is None:
+            return
+        self.latency.add(request_time)
+        route = f"{method} {normalize_route(path)}"
+        if route not in self.routes:
+            if len(self.routes) >= MAX_ROUTES:
+                route = f"{method} (other)"
+            self.routes.setdefault(route, LatencySketch())
+        self.routes[route].add(request_time)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.bytes += other.bytes
+        for when in (other.first, other.last):
+            if when is None:
+                continue
+            if self.first is None or when < self.first:
+                self.first = when
+            if self.last is None or when > self.last:
+                self.last = when
+        self.statuses.update(other.statuses)
+        self.latency.merge(other.latency)
+        for route, sketch in other.routes.items():
+            self.routes.setdefault(route, LatencySketch()).merge(sketch)
+
+    def print_report(self, title, top=10):
+        print(Bcolors.BOLD + title + Bcolors.ENDC)
+        if not self.requests:
+            print("    No requests")
+            return
+        duration = (self.last - self.first).total_seconds() if self.first != self.last else 0
+        print(f"    Period                  {self.first} -> {self.last}")
+        print(f"    Requests                {self.requests} ({self.requests / duration if duration else 0:.2f} req/s)")
+        print(f"    Sent                    {self.bytes / 1024 / 1024:.1f} MiB")
+        classes = Counter()
+        for status, count in self.statuses.items():
+            classes[f"{status[0]}xx"] += count
+        print(f"    Status                  {', '.join(f'{c}: {n / self.requests:.1%}' for c, n in sorted(classes.items()))}")
+        if not self.latency.count:
+            print(Bcolors.WARNING + "    No request time in the log, use the nginx_performance.conf template" + Bcolors.ENDC)
+            return
+        print(f"    Latency p50/p95/p99     {_ms(self.latency.quantile(0.5))} / {_ms(self.latency.quantile(0.95))} / {_ms(self.latency.quantile(0.99))}")
+        print(f"    Slowest endpoints (p95)")
+        slowest = sorted(self.routes.items(), key=lambda item: item[1].quantile(0.95), reverse=True)[:top]
+        for route, sketch in slowest:
+            print(f"        {_ms(sketch.quantile(0.95)):>9}  avg {_ms(sketch.mean()):>9}  max {_ms(sketch.max):>9}  {sketch.count:>8}x  {route}")
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}ms"
+
+
+def normalize_route(path):
+    """ Collapse record ids, slugs and asset hashes so the same route is counted once """
+    path = path.split("?", 1)[0]
+    segments = []
+    for segment in path.split("/"):
+        if ID_SEGMENT_PATTERN.match(segment):
+            segment = ":id"
+        elif SLUG_SEGMENT_PATTERN.match(segment):
+            segment = ":slug"
+        segments.append(segment)
+    return "/".join(segments) or "/"
+
+
+def parse_since(since):
+    """ Parse a relative (30m, 24h, 7d, 2w) or ISO (2024-01-31, 2024-01-31T08:00) date """
+    if not since:
+        return None
+    match = RELATIVE_SINCE_PATTERN.match(since)
+    if match:
+        delta = datetime.timedelta(**{RELATIVE_UNITS[match.group(2)]: int(match.group(1))})
+        return datetime.datetime.now().astimezone() - delta
+    return datetime.datetime.fromisoformat(since).astimezone()
+
+
+def get_access_logs(instance_name):
+    """ Return the access log of an instance and its rotations, oldest first """
+    base = f"{NGINX_LOG_ROOT}{instance_name}.access.log"
+
+    def rotation(path):
+        suffix = path[len(base):].lstrip(".").replace(".gz", "")
+        return int(suffix) if suffix.isdigit() else 0
+
+    paths = [path for path in glob.glob(base + "*") if path == base or rotation(path)]
+    return sorted(paths, key=rotation, reverse=True)
+
+
+def _read_file(path, stats, since, offset=0):
+    """ Stream a log file into stats, return the offset after the last complete line """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        if offset:
+            f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            match = LINE_PATTERN.match(line)
+            if not match:
+                continue
+            try:
+                when = datetime.datetime.strptime(match.group(1).decode(), "%d/%b/%Y:%H:%M:%S %z")
+            except ValueError:
+                continue
+            if since and when < since:
+                continue
+            request_time = REQUEST_TIME_PATTERN.search(line, match.end())
+            stats.add(
+                when,
+                match.group(2).decode(errors="replace"),
+                match.group(3).decode(errors="replace"),
+                match.group(4).decode(),
+                int(match.group(5)) if match.group(5) != b"-" else 0,
+                float(request_time.group(1)) if request_time else None,
+            )
+    return offset
+
+
+def _get_state_path(instance_name):
+    return f"{ROOT}{instance_name}/analytics_state.pkl"
+
+
+def _load_state(instance_name):
+    path = _get_state_path(instance_name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    return None
+
+
+def analyze_instance(instance_name, since=None, resume=False):
+    """ Compute the statistics of an instance access logs
+
+    With resume, the statistics and position saved by the previous run are loaded
+    and only the lines written since then are read.
+    """
+    state = _load_state(instance_name) if resume else None
+    stats = state or LogStats()
+    paths = get_access_logs(instance_name)
+    start = 0
+    if state and state.inode:
+        # Logrotate renames the file, so the last read file is found back by inode
+        for index, path in enumerate(paths):
+            if not path.endswith(".gz") and os.stat(path).st_ino == state.inode:
+                start = index
+                break
+        else:
+            # The file was compressed since, fall back on the time of the last line read
+            state.offset = 0
+            if state.last and (since is None or state.last > since):
+                since = state.last + datetime.timedelta(seconds=1)
+    for index, path in enumerate(paths[start:], start):
+        if since and os.path.getmtime(path) < since.timestamp():
+            continue
+        offset = state.offset if state and index == start else 0
+        offset = _read_file(path, stats, since, offset)
+        if not path.endswith(".gz"):
+            stats.inode = os.stat(path).st_ino
+            stats.offset = offset
+    if resume:
+        with open(_get_state_path(instance_name), "wb") as f:
+            pickle.dump(stats, f)
+    return stats
+
+
+def analyze_instances(instances, since=None, resume=False, top=10):
+    """ Print the report of each instance, and the aggregated report if there are several """
+    total = LogStats()
+    for instance in instances:
+        stats = analyze_instance(instance.instance_name, since, resume)
+        title = f"{instance.name} - {instance.instance_name}" if instance.name else instance.instance_name
+        stats.print_report(title, top)
+        total.merge(stats)
+    if len(instances) > 1:
+        total.print_report("All instances", top)
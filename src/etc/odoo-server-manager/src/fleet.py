@@ -0,0 +1,270 @@
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from src.instance import Instance, load_all_instances, download_release, build_wheelhouse, test_nginx_config, SIZE_CLASSES
+from src.pgbouncer import install_pgbouncer
+from src.utils import Bcolors
+
+ODOO_VERSIONS = ["15.0", "16.0", "17.0"]
+# Spec key: (instance attribute, default)
+SPEC_FIELDS = {
+    'date': ('odoo_date', ''),
+    'server_name': ('server_name', ''),
+    'odoo_template': ('odoo_template', 'odoo.conf'),
+    'service_template': ('service_template', 'service.conf'),
+    'nginx_template': ('nginx_template', 'nginx.conf'),
+    'size': ('size', None),
+    'pgbouncer': ('pgbouncer', False),
+}
+# Changes needing a restart of the instance
+RESTART_CHANGES = {'date', 'code', 'dependencies', 'odoo_template', 'service_template', 'pgbouncer'}
+# Changes needing the release to be installed again
+CODE_CHANGES = {'date', 'code'}
+
+
+def load_spec(path):
+    """ Load a fleet spec file (YAML, or JSON for .json files) """
+    with open(path, "r") as f:
+        if path.endswith(".json"):
+            try:
+                spec = json.load(f)
+            except ValueError as e:
+                raise ValueError(f"Invalid spec: {e}")
+        else:
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required to read YAML specs (apt install python3-yaml), or use a .json spec")
+            try:
+                spec = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"Invalid spec: {e}")
+    if not isinstance(spec, dict):
+        raise ValueError("Invalid spec: the top level must be a mapping with an instances list")
+    return spec
+
+
+def _get_spec_value(spec, key):
+    value = spec.get(key, SPEC_FIELDS[key][1])
+    if value is None:
+        return SPEC_FIELDS[key][1]
+    # YAML reads 20240101 as a number
+    return str(value) if key == 'date' else value
+
+
+def _get_instance_value(instance, key):
+    attribute, default = SPEC_FIELDS[key]
+    return getattr(instance, attribute, default) or default
+
+
+def compute_plan(spec):
+    """ Compare the spec with the registry, return the list of actions
+
+    Instances are matched on their friendly name, unnamed instances are never touched.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("Invalid spec: the top level must be a mapping with an instances list")
+    entries = spec.get('instances') or []
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError("Invalid spec: instances must be a list of mappings")
+    errors = []
+    names = [entry.get('name') for entry in entries]
+    ports = [port for entry in entries for port in (entry.get('port'), entry.get('longpolling_port'))]
+    if any(not name for name in names):
+        errors.append("Every instance needs a name")
+    if len(set(names)) != len(names):
+        errors.append("Instance names must be unique")
+    if len(set(ports)) != len(ports):
+        errors.append("Ports must be unique")
+
+    registry = {instance.name: instance for instance in load_all_instances() if instance.name}
+    plan = []
+    for entry in entries:
+        name = entry.get('name')
+        if str(entry.get('version')) not in ODOO_VERSIONS:
+            errors.append(f"{name}: version must be one of {', '.join(ODOO_VERSIONS)}")
+        if not entry.get('port') or not entry.get('longpolling_port'):
+            errors.append(f"{name}: port and longpolling_port are required")
+        if _get_spec_value(entry, 'size') is not None and _get_spec_value(entry, 'size') not in SIZE_CLASSES:
+            errors.append(f"{name}: size must be one of {', '.join(SIZE_CLASSES)}")
+        instance = registry.get(name)
+        if not instance:
+            plan.append({'action': 'create', 'name': name, 'spec': entry, 'instance': None, 'changes': []})
+            continue
+        if instance.odoo_version != str(entry.get('version')):
+            errors.append(f"{name}: the version of an existing instance cannot be changed")
+        if int(instance.port) != int(entry.get('port') or 0) or int(instance.longpolling_port) != int(entry.get('longpolling_port') or 0):
+            errors.append(f"{name}: the ports of an existing instance cannot be changed")
+        changes = [key for key in SPEC_FIELDS if _get_instance_value(instance, key) != _get_spec_value(entry, key)]
+        # Created by a previous run whose code install failed
+        if not getattr(instance, 'provisioned', True):
+            changes.append('code')
+        if any(dependency not in instance.dependencies for dependency in entry.get('dependencies') or []):
+            changes.append('dependencies')
+        plan.append({'action': 'update' if changes else 'keep', 'name': name, 'spec': entry, 'instance': instance, 'changes': changes})
+
+    if spec.get('prune'):
+        # A typo like instance: would otherwise delete the whole fleet
+        if not entries:
+            raise ValueError("Invalid spec: prune needs a non-empty instances list")
+        for name, instance in registry.items():
+            if name not in names:
+                plan.append({'action': 'delete', 'name': name, 'spec': None, 'instance': instance, 'changes': []})
+
+    if errors:
+        raise ValueError("\n".join(errors))
+    return plan
+
+
+def print_plan(plan):
+    symbols = {
+        'create': Bcolors.OKGREEN + "+",
+        'update': Bcolors.WARNING + "~",
+        'delete': Bcolors.FAIL + "-",
+        'keep': "=",
+    }
+    for action in plan:
+        line = f"{symbols[action['action']]} {action['action']:<7} {action['name']}"
+        if action['action'] == 'create':
+            spec = action['spec']
+            line += f" ({spec['version']}, ports {spec['port']}/{spec['longpolling_port']}, {_get_spec_value(spec, 'size') or 'no size class'})"
+        elif action['changes']:
+            line += f" ({', '.join(action['changes'])})"
+        print(line + Bcolors.ENDC)
+
+
+def _run_parallel(function, items, jobs, label=str):
+    """ Run function on every item with a thread pool, report the failures instead of stopping """
+    failures = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(function, item): item for item in items}
+        for future, item in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failures.append(item)
+                print(Bcolors.FAIL + f"{label(item)}: {e}" + Bcolors.ENDC)
+    return failures
+
+
+def _install_code(action):
+    instance = action['instance']
+    if action['action'] == 'create' or CODE_CHANGES & set(action['changes']):
+        instance.update_odoo_code(download=False)
+    else:
+        instance.update_requirements()
+    instance.provisioned = True
+    instance.save()
+
+
+def apply_plan(plan, jobs=None, wait_ready=False, install_host_dependencies=None):
+    """ Run the plan, doing the shared work once and the per-instance work in parallel """
+    creates = [action for action in plan if action['action'] == 'create']
+    updates = [action for action in plan if action['action'] == 'update']
+    deletes = [action for action in plan if action['action'] == 'delete']
+    if not creates and not updates and not deletes:
+        print("Nothing to do")
+        return
+
+    # Host dependencies, once
+    if creates and install_host_dependencies:
+        install_host_dependencies()
+    if any(_get_spec_value(action['spec'], 'pgbouncer') for action in creates + updates):
+        install_pgbouncer()
+
+    # Releases and wheels, once per release
+    releases = {(str(action['spec']['version']), _get_spec_value(action['spec'], 'date')) for action in creates}
+    releases |= {(action['instance'].odoo_version, _get_spec_value(action['spec'], 'date')) for action in updates if CODE_CHANGES & set(action['changes'])}
+
+    def prepare_release(release):
+        download_release(*release, force=True)
+        build_wheelhouse(*release)
+
+    _run_parallel(prepare_release, sorted(releases), jobs, label=lambda release: f"odoo {' '.join(release)}")
+
+    # Users, roles, configs and sites, serially since they share files (pg_hba, pgbouncer)
+    for action in deletes:
+        print(f"Deleting {action['name']}")
+        for user in action['instance'].user:
+            user.delete()
+        action['instance'].delete(reload=False)
+    failures = []
+    for action in creates:
+        spec = action['spec']
+        print(f"Creating {action['name']}")
+        try:
+            action['instance'] = Instance(
+                friendly_name=action['name'],
+                odoo_version=str(spec['version']),
+                odoo_date=_get_spec_value(spec, 'date'),
+                port=int(spec['port']),
+                longpolling_port=int(spec['longpolling_port']),
+                server_name=_get_spec_value(spec, 'server_name'),
+                odoo_template=_get_spec_value(spec, 'odoo_template'),
+                service_template=_get_spec_value(spec, 'service_template'),
+                nginx_template=_get_spec_value(spec, 'nginx_template'),
+                pgbouncer=_get_spec_value(spec, 'pgbouncer'),
+                size=_get_spec_value(spec, 'size'),
+                deferred=True,
+            )
+        except ValueError as e:
+            failures.append(action)
+            print(Bcolors.FAIL + f"{action['name']}: {e}" + Bcolors.ENDC)
+            continue
+        action['instance'].dependencies = list(spec.get('dependencies') or [])
+    for action in updates:
+        _update_configs(action)
+
+    # Code and venvs, in parallel
+    code_actions = [action for action in creates if action not in failures]
+    code_actions += [action for action in updates if (CODE_CHANGES | {'dependencies'}) & set(action['changes'])]
+    failures += _run_parallel(_install_code, code_actions, jobs, label=lambda action: action['name'])
+
+    # Services, once
+    subprocess.run(["sudo", "systemctl", "daemon-reload"])
+    if creates or deletes:
+        subprocess.run(["sudo", "systemctl", "reload", "postgresql"])
+    if creates or deletes or any({'server_name', 'nginx_template'} & set(action['changes']) for action in updates):
+        if test_nginx_config():
+            print("Reloading nginx")
+            subprocess.run(["sudo", "nginx", "-s", "reload"])
+        else:
+            print(Bcolors.FAIL + "Nginx configuration test failed, nginx was not reloaded" + Bcolors.ENDC)
+
+    restarts = [
+        action['instance'] for action in creates + updates
+        if action not in failures and (action['action'] == 'create' or RESTART_CHANGES & set(action['changes']))
+    ]
+    _run_parallel(lambda instance: instance.restart(wait_ready), restarts, jobs, label=lambda instance: instance.name)
+    print(Bcolors.OKGREEN + f"Applied: {len(creates)} created, {len(updates)} updated, {len(deletes)} deleted, {len(failures)} failed" + Bcolors.ENDC)
+
+
+def _update_configs(action):
+    """ Apply the config changes of an existing instance, the code is installed afterwards """
+    instance = action['instance']
+    spec = action['spec']
+    changes = action['changes']
+    print(f"Updating {action['name']}")
+    if 'date' in changes:
+        instance.odoo_date = _get_spec_value(spec, 'date')
+    if 'dependencies' in changes:
+        instance.dependencies += [dependency for dependency in spec['dependencies'] if dependency not in instance.dependencies]
+    if 'odoo_template' in changes:
+        instance.odoo_template = _get_spec_value(spec, 'odoo_template')
+        instance._create_odoo_config()
+    if 'service_template' in changes:
+        instance.service_template = _get_spec_value(spec, 'service_template')
+        instance._create_service_config()
+    if 'server_name' in changes or 'nginx_template' in changes:
+        instance.server_name = _get_spec_value(spec, 'server_name')
+        instance.nginx_template = _get_spec_value(spec, 'nginx_template')
+        instance._create_ngnix_config(reload=False)
+    if 'size' in changes:
+        instance.resize(_get_spec_value(spec, 'size'))
+    if 'pgbouncer' in changes:
+        if _get_spec_value(spec, 'pgbouncer'):
+            instance.enable_pgbouncer()
+        else:
+            instance.disable_pgbouncer()
+    instance.save()
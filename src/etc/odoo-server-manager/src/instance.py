@@ -1,16 +1,52 @@
 import os
+import glob
 import pickle
 import subprocess
 import hashlib
 import datetime
+import re
+import time
+import urllib.parse
 import requests
 
 from src.user import User
+from src.pgbouncer import PGBOUNCER_PORT, install_pgbouncer, create_pgbouncer_config
 from src.utils import check_if_port_is_free, check_if_port_is_valid, check_if_firewall_is_enabled, get_postgres_version, \
-    Bcolors
+    get_total_memory, Bcolors
 
 ROOT = '/opt/odoo/'
 TEMPLATE_ROOT = '/etc/odoo-server-manager/src/template/'
+RELEASE_CACHE = '/var/cache/odoo-server-manager/releases/'
+WHEELHOUSE = '/var/cache/odoo-server-manager/wheels/'
+NGINX_SHARED_CONFIG = '/etc/nginx/conf.d/odoo-server-manager.conf'
+NGINX_CACHE_PATH = '/var/cache/nginx/odoo'
+# Names defined by the shared config, a site referring to one of them needs it
+NGINX_SHARED_NAMES = ['odoo_timing', 'odoo_static', 'odoo_connection_upgrade']
+READY_ROUTES = ['/web/health', '/web/login']
+# Anonymous requests on /web are redirected to /web/login, so only the login page is warmed by default
+DEFAULT_WARMUP_ROUTES = ['/web/login']
+MAX_RESTART_HISTORY = 50
+# Longest wait for the old nginx workers before stopping a temporary process, long polling may keep them
+NGINX_DRAIN_TIMEOUT = 60
+# Default db_maxconn written to odoo.conf with pgbouncer, per process (prefork) or for the single process (threaded)
+DB_MAXCONN_PREFORK = 4
+DB_MAXCONN_THREADED = 64
+# memory: share of the host memory, cpus: number of cpus, weight: cpu and io weight
+SIZE_CLASSES = {
+    'small': {'memory': 0.10, 'cpus': 0.5, 'weight': 50, 'tasks': 256},
+    'medium': {'memory': 0.20, 'cpus': 1, 'weight': 100, 'tasks': 512},
+    'large': {'memory': 0.35, 'cpus': 2, 'weight': 200, 'tasks': 1024},
+    'xlarge': {'memory': 0.50, 'cpus': 4, 'weight': 400, 'tasks': 2048},
+}
+# systemd property: resource limit key
+RESOURCE_PROPERTIES = {
+    'MemoryHigh': 'memory_high',
+    'MemoryMax': 'memory_max',
+    'CPUWeight': 'cpu_weight',
+    'CPUQuota': 'cpu_quota',
+    'IOWeight': 'io_weight',
+    'TasksMax': 'tasks_max',
+}
 
 
 def check_if_port_is_available(port):
@@ -36,6 +72,190 @@ def check_port(port):
     return False
 
 
+def find_spare_port(exclude=None, start=20000, end=30000):
+    """ Find a free port not used by any odoo instance, used for temporary processes """
+    exclude = exclude or []
+    used = set()
+    for instance_data in load_all_instances():
+        used.add(int(instance_data.port))
+        used.add(int(instance_data.longpolling_port))
+    for port in range(start, end):
+        if port not in exclude and port not in used and check_if_port_is_free(port):
+            return port
+    raise ValueError("No spare port available")
+
+
+def get_release_name(odoo_version, odoo_date=None):
+    if odoo_date:
+        return f"odoo_{odoo_version}_{odoo_date}.zip"
+    return f"odoo_{odoo_version}.latest.zip"
+
+
+def download_release(odoo_version, odoo_date=None, force=False):
+    """ Download an Odoo release in the shared cache, dated releases are only downloaded once """
+    release_name = get_release_name(odoo_version, odoo_date)
+    release_path = RELEASE_CACHE + release_name
+    if os.path.exists(release_path) and (odoo_date or not force):
+        print(f"Using cached release {release_name}")
+        return release_path
+    subprocess.run(f"sudo mkdir -p {RELEASE_CACHE}", shell=True)
+    if os.path.exists(release_path):
+        # The build being replaced may still run on other instances
+        keep_release_build(odoo_version, release_path)
+    wget_command = f"sudo wget https://nightly.odoo.com/{odoo_version}/nightly/src/{release_name} -O {release_path}.part"
+    if subprocess.run(wget_command, shell=True).returncode == 0:
+        subprocess.run(f"sudo mv {release_path}.part {release_path}", shell=True)
+    else:
+        subprocess.run(f"sudo rm -f {release_path}.part", shell=True)
+    return release_path
+
+
+def get_release_sha256(release_path):
+    """ Content hash of a release zip, latest releases share a file name across builds """
+    digest = hashlib.sha256()
+    with open(release_path, "rb") as f:
+        while data := f.read(1024 * 1024):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def get_release_build_path(odoo_version, sha256):
+    """ Path of a latest release build kept under its content hash """
+    return f"{RELEASE_CACHE}odoo_{odoo_version}.latest.{sha256}.zip"
+
+
+def keep_release_build(odoo_version, release_path, sha256=None):
+    """ Hard link a latest release under its content hash, it stays available once a newer build is downloaded """
+    sha256 = sha256 or get_release_sha256(release_path)
+    build_path = get_release_build_path(odoo_version, sha256)
+    if not os.path.exists(build_path):
+        subprocess.run(["sudo", "ln", "-f", release_path, build_path])
+    return sha256
+
+
+def prune_release_builds(instance):
+    """ Remove the kept latest builds of the instance version that no instance runs anymore """
+    odoo_version = instance.odoo_version
+    # The saved data of the instance still has the build it is moving away from
+    used = {getattr(instance_data, 'release_sha256', None) for instance_data in load_all_instances() if instance_data.instance_name != instance.instance_name}
+    used.add(instance.release_sha256)
+    prefix = get_release_build_path(odoo_version, "")[:-len(".zip")]
+    for path in glob.glob(get_release_build_path(odoo_version, "*")):
+        if path[len(prefix):-len(".zip")] not in used:
+            subprocess.run(["sudo", "rm", "-f", path])
+
+
+def get_wheelhouse(odoo_version, odoo_date=None):
+    return WHEELHOUSE + get_release_name(odoo_version, odoo_date)[:-len(".zip")]
+
+
+def build_wheelhouse(odoo_version, odoo_date=None):
+    """ Build the wheels of a release requirements once, venvs of the release install from them """
+    wheelhouse = get_wheelhouse(odoo_version, odoo_date)
+    if os.path.isdir(wheelhouse):
+        return
+    release_name = get_release_name(odoo_version, odoo_date)
+    print(f"Building wheels for {release_name}")
+    requirements = f"{wheelhouse}.requirements.txt"
+    subprocess.run(f"sudo mkdir -p {WHEELHOUSE}", shell=True)
+    subprocess.run(f"sudo unzip -p {RELEASE_CACHE}{release_name} '*/requirements.txt' | sudo tee {requirements} > /dev/null", shell=True)
+    if subprocess.run(f"sudo python3 -m pip wheel -q -r {requirements} -w {wheelhouse}.part", shell=True).returncode == 0:
+        subprocess.run(f"sudo mv {wheelhouse}.part {wheelhouse}", shell=True)
+    else:
+        subprocess.run(f"sudo rm -rf {wheelhouse}.part", shell=True)
+
+
+def uses_nginx_shared_config(site):
+    """ Check if a site refers to the log format, map or cache zone of the shared config """
+    return any(name in site for name in NGINX_SHARED_NAMES)
+
+
+def read_nginx_shared_config():
+    """ Return the current shared config, None if it is not installed """
+    if not os.path.exists(NGINX_SHARED_CONFIG):
+        return None
+    with open(NGINX_SHARED_CONFIG, "r") as f:
+        return f.read()
+
+
+def restore_nginx_shared_config(content):
+    """ Put back the shared config returned by read_nginx_shared_config """
+    if content is None:
+        subprocess.run(["sudo", "rm", "-f", NGINX_SHARED_CONFIG])
+        return
+    with open(NGINX_SHARED_CONFIG, "w") as f:
+        f.write(content)
+
+
+def create_nginx_shared_config():
+    """ Write the http level nginx configuration (log format, cache zone) shared by the performance sites """
+    shared_template = open(TEMPLATE_ROOT + "nginx_shared.conf", "r").read()
+    shared_template = shared_template.replace("{{nginx_cache_path}}", NGINX_CACHE_PATH)
+    # nginx only creates the last component of the cache path
+    subprocess.run(["sudo", "mkdir", "-p", NGINX_CACHE_PATH])
+    if read_nginx_shared_config() == shared_template:
+        return
+    print("Creating nginx shared config")
+    with open(NGINX_SHARED_CONFIG, "w") as f:
+        f.write(shared_template)
+
+
+def test_nginx_config():
+    """ Check the nginx configuration """
+    return subprocess.run(["sudo", "nginx", "-t"]).returncode == 0
+
+
+def wait_for_nginx_drain(timeout=NGINX_DRAIN_TIMEOUT, interval=1):
+    """ Wait until the nginx workers left by the last reload have exited, return False on timeout """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # Sleep first, the reload signal is handled asynchronously by the nginx master
+        time.sleep(interval)
+        if subprocess.run(["pgrep", "-f", "nginx: worker process is shutting down"], stdout=subprocess.DEVNULL).returncode != 0:
+            return True
+    print(Bcolors.WARNING + f"Nginx workers still draining after {timeout}s" + Bcolors.ENDC)
+    return False
+
+
+def regenerate_nginx_configs(nginx_template=None):
+    """ Rewrite the site of every instance, then test and reload nginx once
+
+    The previous sites are restored if the test fails, the instances are only saved once it passes.
+    """
+    instances = load_all_instances()
+    previous_shared = read_nginx_shared_config()
+    previous = {}
+    for instance_data in instances:
+        site_path = f"/etc/nginx/sites-available/{instance_data.instance_name}"
+        content = None
+        if os.path.exists(site_path):
+            with open(site_path, "r") as f:
+                content = f.read()
+        enabled = os.path.exists(f"/etc/nginx/sites-enabled/{instance_data.instance_name}")
+        previous[instance_data.instance_name] = (content, enabled, instance_data.nginx_template)
+        if nginx_template:
+            instance_data.nginx_template = nginx_template
+        instance_data._create_ngnix_config(reload=False)
+    if not test_nginx_config():
+        print(Bcolors.FAIL + "Nginx configuration test failed, restoring the previous sites" + Bcolors.ENDC)
+        restore_nginx_shared_config(previous_shared)
+        for instance_data in instances:
+            content, enabled, instance_data.nginx_template = previous[instance_data.instance_name]
+            if not enabled:
+                instance_data.disable_site()
+            if content is None:
+                subprocess.run(["sudo", "rm", "-f", f"/etc/nginx/sites-available/{instance_data.instance_name}"])
+                continue
+            with open(f"/etc/nginx/sites-available/{instance_data.instance_name}", "w") as f:
+                f.write(content)
+        return False
+    for instance_data in instances:
+        instance_data.save()
+    print("Reloading nginx")
+    subprocess.run(["sudo", "nginx", "-s", "reload"])
+    return True
+
+
 class Instance:
     def __init__(
             self,
@@ -48,6 +268,10 @@ class Instance:
             odoo_template: str = None,
             service_template: str = None,
             nginx_template: str = None,
+            wait_ready: bool = False,
+            pgbouncer: bool = False,
+            size: str = None,
+            deferred: bool = False,
     ):
         self.create_datetime = datetime.datetime.now()
         self.instance_name = hashlib.md5(f"{odoo_version}-{self.create_datetime}".encode()).hexdigest()
@@ -63,6 +287,10 @@ class Instance:
         self.nginx_template = nginx_template or 'nginx.conf'
         self.user = []
         self.dependencies = []
+        self.warmup_routes = list(DEFAULT_WARMUP_ROUTES)
+        self.restart_history = []
+        self.pgbouncer = pgbouncer
+        self.size = size
         # Check if port is free
         if not check_port(self.port):
             raise ValueError("Port is not free")
@@ -70,10 +298,19 @@ class Instance:
             raise ValueError("Longpolling port is not free")
         if check_if_firewall_is_enabled():
             print(Bcolors.WARNING + "Firewall is enabled. Please add port to firewall if needed." + Bcolors.ENDC)
+        if deferred:
+            # Only create the configs, the caller installs the code, sets provisioned and reloads the services
+            self.provisioned = False
+            self._create(reload=False)
+            self.save()
+            return
+        if self.pgbouncer:
+            install_pgbouncer()
         self._create()
         self.update_odoo_code()
+        self.provisioned = True
         self.save()
-        self.restart()
+        self.restart(wait_ready)
 
     def add_user(self, username):
         user = User(username)
@@ -90,49 +327,146 @@ class Instance:
     def _venv_exists(self):
         return os.path.exists(f"{ROOT}{self.instance_name}/venv")
 
-    def _replace_template(self, template):
+    def _replace_template(self, template, port=None, longpolling_port=None):
         template = template.replace("{{instance_name}}", self.instance_name)
         template = template.replace("{{create_datetime}}", str(self.create_datetime))
         template = template.replace("{{ROOT}}", ROOT)
         template = template.replace("{{odoo_version}}", self.odoo_version)
-        template = template.replace("{{port}}", str(self.port))
-        template = template.replace("{{longpolling_port}}", str(self.longpolling_port))
+        template = template.replace("{{port}}", str(port or self.port))
+        template = template.replace("{{longpolling_port}}", str(longpolling_port or self.longpolling_port))
+        for key, value in self.get_resource_limits().items():
+            template = template.replace("{{" + key + "}}", value)
         return template
 
+    def get_resource_limits(self):
+        """ Systemd resource controls of the size class, relative to the host capacity
+
+        Without a size class there is no hard limit, only the default weights and a memory
+        pressure threshold at an even share of the host memory between the instances.
+        """
+        size = getattr(self, 'size', None)
+        if size is None:
+            instances = len([instance for instance in load_all_instances() if instance.instance_name != self.instance_name]) + 1
+            return {
+                'memory_high': f"{get_total_memory() * 85 // 100 // instances // 1024 // 1024}M",
+                'memory_max': "infinity",
+                'cpu_weight': "100",
+                'cpu_quota': "",
+                'io_weight': "100",
+                'tasks_max': "infinity",
+            }
+        size_class = SIZE_CLASSES[size]
+        memory_max = int(get_total_memory() * size_class['memory'])
+        cpus = min(size_class['cpus'], os.cpu_count() or 1)
+        return {
+            'memory_high': f"{memory_max * 85 // 100 // 1024 // 1024}M",
+            'memory_max': f"{memory_max // 1024 // 1024}M",
+            'cpu_weight': str(size_class['weight']),
+            'cpu_quota': f"{int(cpus * 100)}%",
+            'io_weight': str(size_class['weight']),
+            'tasks_max': str(size_class['tasks']),
+        }
+
+    def resize(self, size):
+        """ Change the size class (None to remove it), applied live with systemctl set-property
+
+        The limits are persisted in the service file, set-property only applies them to the
+        running service (--runtime) so no drop-in overrides a later change of the service file.
+        """
+        self.size = size
+        self._create_service_config()
+        # Persistent drop-in left by the resizes done before --runtime was used
+        subprocess.run(["sudo", "rm", "-rf", f"/etc/systemd/system.control/{self.instance_name}.service.d"])
+        subprocess.run(["sudo", "systemctl", "daemon-reload"])
+        print("Applying resource limits")
+        subprocess.run(["sudo", "systemctl", "set-property", "--runtime", self.instance_name + ".service"] + self._get_resource_properties())
+        self.save()
+
+    def _get_resource_properties(self):
+        limits = self.get_resource_limits()
+        return [f"{name}={limits[key]}" for name, key in RESOURCE_PROPERTIES.items()]
+
     def get_server_name(self):
         return self.server_name or f"{self.instance_name}.example.com"
 
+    def _get_python(self):
+        """ Return the interpreter used to run the instance (venv if available) """
+        if self._venv_exists():
+            return f"{ROOT}{self.instance_name}/venv/bin/python"
+        return "python3"
+
     def _get_master_pwd(self):
         with open(f"{ROOT}{self.instance_name}/odoo.conf", "r") as f:
             for line in f.readlines():
                 if "admin_passwd" in line:
                     return line.split(" = ")[1].strip()
 
+    def _get_odoo_config_option(self, key, default=None):
+        if os.path.exists(f"{ROOT}{self.instance_name}/odoo.conf"):
+            with open(f"{ROOT}{self.instance_name}/odoo.conf", "r") as f:
+                for line in f.readlines():
+                    if line.split("=")[0].strip() == key:
+                        return line.split("=", 1)[1].strip()
+        return default
+
+    def _set_odoo_config_option(self, key, value):
+        with open(f"{ROOT}{self.instance_name}/odoo.conf", "r") as f:
+            lines = f.readlines()
+        for index, line in enumerate(lines):
+            if line.split("=")[0].strip() == key:
+                lines[index] = f"{key} = {value}\n"
+                break
+        else:
+            if lines and not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            lines.append(f"{key} = {value}\n")
+        with open(f"{ROOT}{self.instance_name}/odoo.conf", "w") as f:
+            f.writelines(lines)
+
+    def get_db_maxconn(self):
+        """ Connections each Odoo process may open, db_maxconn of odoo.conf or the default of the server mode """
+        workers = int(self._get_odoo_config_option("workers", 0))
+        return int(self._get_odoo_config_option("db_maxconn", DB_MAXCONN_PREFORK if workers else DB_MAXCONN_THREADED))
+
+    def get_pool_size(self, rolling=False):
+        """ Connections needed by the instance, with rolling the temporary process of a rolling restart is counted """
+        workers = int(self._get_odoo_config_option("workers", 0))
+        cron_threads = int(self._get_odoo_config_option("max_cron_threads", 2))
+        if workers:
+            # Workers, cron workers, gevent and master, the temporary process has no cron
+            processes = workers + cron_threads + 2
+            if rolling:
+                processes += workers + 2
+        else:
+            # Threaded server, cron threads share the process pool
+            processes = 2 if rolling else 1
+        return processes * self.get_db_maxconn()
+
     ############################
     # Update methods
     ############################
 
-    def update_odoo_code(self):
+    def get_release_name(self):
+        return get_release_name(self.odoo_version, self.odoo_date)
+
+    def download_release(self, force=False):
+        return download_release(self.odoo_version, self.odoo_date, force)
+
+    def update_odoo_code(self, download=True):
         if os.path.exists(f"{ROOT}{self.instance_name}/update_temp"):
             subprocess.run(f"sudo rm -rf {ROOT}{self.instance_name}/update_temp", shell=True)
         subprocess.run(f"sudo mkdir {ROOT}{self.instance_name}/update_temp", shell=True)
 
-        if self.odoo_date:
-            if os.path.exists(f"{ROOT}{self.instance_name}/odoo_{self.odoo_version}_{self.odoo_date}.zip"):
-                subprocess.run(f"sudo rm -rf {ROOT}{self.instance_name}/odoo_{self.odoo_version}_{self.odoo_date}.zip", shell=True)
+        release_path = self.download_release(force=download)
+        subprocess.run(f"sudo unzip -q {release_path} -d {ROOT}{self.instance_name}/update_temp", shell=True)
+        # Identifies the build of a latest release, see transfer.get_release_source
+        self.release_sha256 = get_release_sha256(release_path)
+        if not self.odoo_date:
+            keep_release_build(self.odoo_version, release_path, self.release_sha256)
+        prune_release_builds(self)
 
-            wget_command = f"sudo wget https://nightly.odoo.com/{self.odoo_version}/nightly/src/odoo_{self.odoo_version}_{self.odoo_date}.zip -P {ROOT}{self.instance_name}"
-            subprocess.run(wget_command, shell=True)
-
-            subprocess.run(f"sudo unzip -q {ROOT}{self.instance_name}/odoo_{self.odoo_version}_{self.odoo_date}.zip -d {ROOT}{self.instance_name}/update_temp", shell=True)
-        else:
-            if os.path.exists(f"{ROOT}{self.instance_name}/odoo_{self.odoo_version}.latest.zip"):
-                subprocess.run(f"sudo rm -rf {ROOT}{self.instance_name}/odoo_{self.odoo_version}.latest.zip", shell=True)
-
-            wget_command = f"sudo wget https://nightly.odoo.com/{self.odoo_version}/nightly/src/odoo_{self.odoo_version}.latest.zip -P {ROOT}{self.instance_name}"
-            subprocess.run(wget_command, shell=True)
-
-            subprocess.run(f"sudo unzip -q {ROOT}{self.instance_name}/odoo_{self.odoo_version}.latest.zip -d {ROOT}{self.instance_name}/update_temp", shell=True)
+        # Precompile the new source while the old version is still serving
+        self.compile_bytecode(f"{ROOT}{self.instance_name}/update_temp/*/", f"{ROOT}{self.instance_name}/src")
 
         if os.path.exists(f"{ROOT}{self.instance_name}/src"):
             subprocess.run(f"sudo rm -rf {ROOT}{self.instance_name}/src", shell=True)
@@ -150,9 +484,24 @@ class Instance:
         if not self._venv_exists():
             self._create_venv()
         if os.path.exists(f"{ROOT}{self.instance_name}/src/requirements.txt"):
-            subprocess.run(f"sudo -u {self.instance_name} bash -c \"source {ROOT}{self.instance_name}/venv/bin/activate && pip3 install --upgrade pip && pip3 install wheel && pip3 install -r {ROOT}{self.instance_name}/src/requirements.txt && deactivate\"", shell=True)
+            wheelhouse = get_wheelhouse(self.odoo_version, self.odoo_date)
+            find_links = f"--find-links {wheelhouse} " if os.path.isdir(wheelhouse) else ""
+            subprocess.run(f"sudo -u {self.instance_name} bash -c \"source {ROOT}{self.instance_name}/venv/bin/activate && pip3 install --upgrade pip && pip3 install wheel && pip3 install {find_links}-r {ROOT}{self.instance_name}/src/requirements.txt && deactivate\"", shell=True)
             for dependency in self.dependencies:
-                subprocess.run(f"sudo -u {self.instance_name} bash -c \"source {ROOT}{self.instance_name}/venv/bin/activate && pip3 install --upgrade pip && pip3 install {dependency} && deactivate\"", shell=True)
+                # No shell, specifiers like Babel>=2.9 and VCS URLs are passed as is
+                subprocess.run(["sudo", "-u", self.instance_name, f"{ROOT}{self.instance_name}/venv/bin/pip3", "install", dependency])
+        self.compile_bytecode(f"{ROOT}{self.instance_name}/venv/lib")
+
+    def compile_bytecode(self, path, destination=None):
+        """ Byte-compile a tree in parallel on all cores so the first start does not have to """
+        print(f"Compiling bytecode ({path})")
+        start = datetime.datetime.now()
+        command = f"sudo {self._get_python()} -m compileall -qq -j 0"
+        if destination:
+            command += f" -d {destination}"
+        subprocess.run(f"{command} {path}", shell=True)
+        subprocess.run(f"sudo chown -R {self.instance_name}:{self.instance_name} {path}", shell=True)
+        print(f"Bytecode compiled in {(datetime.datetime.now() - start).total_seconds():.1f}s")
 
     def add_dependency(self, dependency):
         if dependency not in self.dependencies:
@@ -164,16 +513,16 @@ class Instance:
     # Create methods
     ############################
 
-    def _create(self):
+    def _create(self, reload=True):
         self._create_user()
         self._create_folder_structure()
-        self._create_postgresql_user()
+        self._create_postgresql_user(reload)
         self._create_venv()
         self._create_odoo_config()
         self.chown()
 
         self._create_service_config()
-        self._create_ngnix_config()
+        self._create_ngnix_config(reload=reload)
 
     def _create_user(self):
         print("Creating user")
@@ -189,12 +538,13 @@ class Instance:
         subprocess.run(f"sudo mkdir {ROOT}{self.instance_name}/custom_addons", shell=True)
         subprocess.run(f"sudo chmod -R 775 {ROOT}{self.instance_name}/custom_addons", shell=True)
 
-    def _create_postgresql_user(self):
+    def _create_postgresql_user(self, reload=True):
         version = get_postgres_version()
         subprocess.run(["sudo", "-u", "postgres", "createuser", "-d", "-r", "-s", self.instance_name])
         line = "/# Database administrative login by Unix domain socket/i host    all    " + self.instance_name + "    127.0.0.1/32    trust"
         subprocess.run(["sudo", "sed", "-i", line, f"/etc/postgresql/{version}/main/pg_hba.conf"])
-        self.restart_postgresql()
+        if reload:
+            self.restart_postgresql()
 
     def _create_venv(self):
         self.chown()
@@ -213,6 +563,22 @@ class Instance:
         odoo_template = self._replace_template(odoo_template)
         with open(f"{ROOT}{self.instance_name}/odoo.conf", "w") as f:
             f.write(odoo_template)
+        if getattr(self, 'pgbouncer', False):
+            self._set_pgbouncer_options()
+            self._create_pgbouncer_config()
+
+    def _set_pgbouncer_options(self):
+        """ Connect through pgbouncer, with db_maxconn matching the pool size of the instance """
+        self._set_odoo_config_option("db_host", "127.0.0.1")
+        self._set_odoo_config_option("db_port", PGBOUNCER_PORT)
+        self._set_odoo_config_option("db_maxconn", self.get_db_maxconn())
+
+    def _create_pgbouncer_config(self, exclude=False):
+        """ Regenerate the pgbouncer config from the registry, with this instance up to date """
+        instances = [instance for instance in load_all_instances() if instance.instance_name != self.instance_name]
+        if not exclude:
+            instances.append(self)
+        create_pgbouncer_config(instances)
 
     def _create_service_config(self):
         if os.path.exists(f"/etc/systemd/system/{self.instance_name}.service"):
@@ -225,7 +591,7 @@ class Instance:
             f.write(service_template)
         self.enable()
 
-    def _create_ngnix_config(self):
+    def _create_ngnix_config(self, port=None, longpolling_port=None, reload=True):
         if os.path.exists(f"/etc/nginx/sites-enabled/{self.instance_name}"):
             print("Removing old nginx config (enabled)")
             subprocess.run(f"sudo rm -rf /etc/nginx/sites-enabled/{self.instance_name}", shell=True)
@@ -234,12 +600,35 @@ class Instance:
             subprocess.run(f"sudo rm -rf /etc/nginx/sites-available/{self.instance_name}", shell=True)
         print("Creating nginx config")
         nginx_template = open(TEMPLATE_ROOT + self.nginx_template, "r").read()
-        nginx_template = self._replace_template(nginx_template)
+        nginx_template = self._replace_template(nginx_template, port, longpolling_port)
         nginx_template = nginx_template.replace("{{server_name}}", self.get_server_name())
         with open(f"/etc/nginx/sites-available/{self.instance_name}", "w") as f:
             f.write(nginx_template)
+        # Also refreshed when installed, older versions put open_file_cache in it for every vhost
+        if uses_nginx_shared_config(nginx_template) or read_nginx_shared_config() is not None:
+            create_nginx_shared_config()
         self.enable_site()
+        if not reload:
+            return True
+        if not test_nginx_config():
+            print(Bcolors.FAIL + "Nginx configuration test failed, nginx was not reloaded and the site is not live" + Bcolors.ENDC)
+            return False
         self.reload_nginx()
+        return True
+
+    def enable_pgbouncer(self):
+        install_pgbouncer()
+        self.pgbouncer = True
+        self._set_pgbouncer_options()
+        self._create_pgbouncer_config()
+        self.save()
+
+    def disable_pgbouncer(self):
+        self.pgbouncer = False
+        self._set_odoo_config_option("db_host", "localhost")
+        self._set_odoo_config_option("db_port", 5432)
+        self._create_pgbouncer_config(exclude=True)
+        self.save()
 
     ############################
     # Reset methods
@@ -259,7 +648,7 @@ class Instance:
     # Delete methods
     ############################
 
-    def delete(self):
+    def delete(self, reload=True):
         version = get_postgres_version()
         command = f"sudo -u postgres psql -c 'DROP DATABASE IF EXISTS (SELECT datname FROM pg_database WHERE datdba = (SELECT usesysid FROM pg_user WHERE usename = \'{self.instance_name}\'));'"
         subprocess.run(command, shell=True)
@@ -267,17 +656,22 @@ class Instance:
 
         line = "/host    all    " + self.instance_name + "    127.0.0.1/32    trust/d"
         subprocess.run(["sudo", "sed", "-i", line, f"/etc/postgresql/{version}/main/pg_hba.conf"])
+        if getattr(self, 'pgbouncer', False):
+            self._create_pgbouncer_config(exclude=True)
 
         self.disable()
         subprocess.run(f"sudo rm -rf /etc/systemd/system/{self.instance_name}.service", shell=True)
         subprocess.run(["sudo", "rm", "-rf", f"/etc/systemd/system/multi-user.target.wants/{self.instance_name}.service"])
+        # Drop-ins written by systemctl set-property
+        subprocess.run(["sudo", "rm", "-rf", f"/etc/systemd/system.control/{self.instance_name}.service.d", f"/run/systemd/system.control/{self.instance_name}.service.d"])
 
         subprocess.run(f"sudo rm -rf /etc/nginx/sites-available/{self.instance_name}", shell=True)
         subprocess.run(f"sudo rm -rf /etc/nginx/sites-enabled/{self.instance_name}", shell=True)
 
-        subprocess.run(["sudo", "systemctl", "daemon-reload"])
-        subprocess.run(["sudo", "systemctl", "restart", "nginx"])
-        subprocess.run(["sudo", "systemctl", "restart", "postgresql"])
+        if reload:
+            subprocess.run(["sudo", "systemctl", "daemon-reload"])
+            subprocess.run(["sudo", "systemctl", "restart", "nginx"])
+            subprocess.run(["sudo", "systemctl", "restart", "postgresql"])
 
         subprocess.run(f"sudo userdel -r {self.instance_name}", shell=True)
         subprocess.run(f"sudo rm -rf {ROOT}{self.instance_name}", shell=True)
@@ -349,9 +743,118 @@ class Instance:
     def is_running(self):
         return subprocess.run(["sudo", "systemctl", "is-active", self.instance_name + ".service"], stdout=subprocess.PIPE).returncode == 0
 
-    def restart(self):
+    def restart(self, wait_ready=False, rolling=False):
+        if rolling:
+            self.rolling_restart()
+            return
         print("Restarting service")
+        start = time.monotonic()
+        subprocess.run(["sudo", "systemctl", "restart", self.instance_name + ".service"])
+        if wait_ready:
+            if self.wait_until_ready():
+                self._record_restart(time.monotonic() - start)
+                self.warm_up()
+            else:
+                print(Bcolors.WARNING + "Instance did not become ready in time" + Bcolors.ENDC)
+
+    def rolling_restart(self):
+        """ Restart without downtime: serve from a temporary process while the service restarts """
+        print("Rolling restart")
+        port = find_spare_port()
+        longpolling_port = find_spare_port(exclude=[port])
+        longpolling_option = "--longpolling-port" if self.odoo_version == "15.0" else "--gevent-port"
+        subprocess.run([
+            "sudo", "systemd-run", "--collect", "--unit", self.instance_name + "-rolling.service",
+            "--uid", self.instance_name, "--gid", self.instance_name,
+            *[option for prop in self._get_resource_properties() for option in ("-p", prop)],
+            f"{ROOT}{self.instance_name}/venv/bin/python", f"{ROOT}{self.instance_name}/src/odoo-bin",
+            "-c", f"{ROOT}{self.instance_name}/odoo.conf", "--http-port", str(port), longpolling_option, str(longpolling_port),
+            "--max-cron-threads", "0", "--logfile", f"{ROOT}{self.instance_name}/logs/odoo-rolling.log",
+        ])
+        if not self.wait_until_ready(port=port):
+            print(Bcolors.WARNING + "Temporary process did not become ready, falling back to a plain restart" + Bcolors.ENDC)
+            subprocess.run(["sudo", "systemctl", "stop", self.instance_name + "-rolling.service"])
+            self.restart(wait_ready=True)
+            return
+
+        # Switch nginx to the temporary process, the old one drains on restart
+        if not self._create_ngnix_config(port, longpolling_port):
+            print(Bcolors.WARNING + "Nginx could not be switched to the temporary process, falling back to a plain restart" + Bcolors.ENDC)
+            subprocess.run(["sudo", "systemctl", "stop", self.instance_name + "-rolling.service"])
+            self._create_ngnix_config(reload=False)
+            self.restart(wait_ready=True)
+            return
+        start = time.monotonic()
         subprocess.run(["sudo", "systemctl", "restart", self.instance_name + ".service"])
+        if not self.wait_until_ready():
+            print(Bcolors.FAIL + "Service did not become ready, nginx is left on the temporary process" + Bcolors.ENDC)
+            return
+        self._record_restart(time.monotonic() - start)
+        self._create_ngnix_config()
+        # Requests in flight on the temporary process are served by the old nginx workers until they exit
+        wait_for_nginx_drain()
+        subprocess.run(["sudo", "systemctl", "stop", self.instance_name + "-rolling.service"])
+        self.warm_up()
+
+    def wait_until_ready(self, timeout=300, interval=1, port=None):
+        """ Poll the instance HTTP port until it answers, return True if ready before the timeout """
+        print("Waiting for instance to be ready")
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for route in READY_ROUTES:
+                try:
+                    response = requests.get(f"http://127.0.0.1:{port or self.port}{route}", headers=self._get_local_headers(), timeout=5)
+                except requests.RequestException:
+                    break
+                if response.status_code < 400:
+                    return True
+            time.sleep(interval)
+        return False
+
+    def _get_local_headers(self):
+        """ Requests sent on the local port carry the public host name, so dbfilter selects the right database """
+        return {"Host": self.get_server_name()}
+
+    def warm_up(self):
+        """ Request the warm-up routes and the asset bundles they reference
+
+        Only anonymous pages are warmed: the backend bundle (web.assets_backend, web.assets_web
+        on 17.0) is only referenced once logged in and is compiled by the first backend load.
+        """
+        print("Warming up instance")
+        routes = list(getattr(self, 'warmup_routes', DEFAULT_WARMUP_ROUTES))
+        done = set()
+        while routes:
+            route = routes.pop(0)
+            if route in done:
+                continue
+            done.add(route)
+            try:
+                # Redirects are followed by hand, Odoo builds them on the public host name
+                response = requests.get(f"http://127.0.0.1:{self.port}{route}", headers=self._get_local_headers(), timeout=120, allow_redirects=False)
+            except requests.RequestException as e:
+                print(f"Warm-up of {route} failed: {e}")
+                continue
+            if response.is_redirect:
+                location = urllib.parse.urlsplit(response.headers["Location"])
+                routes.append(location.path + (f"?{location.query}" if location.query else ""))
+            elif "text/html" in response.headers.get("Content-Type", ""):
+                routes += re.findall(r'(?:src|href)="(/web/assets/[^"]+)"', response.text)
+        print(f"Warmed up {len(done)} urls")
+
+    def _record_restart(self, seconds):
+        """ Keep the restart-to-ready time along with the running release """
+        print(f"Instance ready in {seconds:.1f}s")
+        history = getattr(self, 'restart_history', [])
+        history.append({
+            'datetime': datetime.datetime.now(),
+            'seconds': round(seconds, 1),
+            'odoo_version': self.odoo_version,
+            'odoo_date': self.odoo_date,
+            'last_update_datetime': self.last_update_datetime,
+        })
+        self.restart_history = history[-MAX_RESTART_HISTORY:]
+        self.save()
 
     def start(self):
         print("Starting service")
@@ -438,6 +941,13 @@ class Instance:
         print(f"    Longpolling port        {self.longpolling_port}")
         print(f"    Create datetime         {self.create_datetime}")
         print(f"    Last update datetime    {self.last_update_datetime}")
+        history = getattr(self, 'restart_history', [])
+        if history:
+            average = sum(restart['seconds'] for restart in history) / len(history)
+            print(f"    Restart to ready        {history[-1]['seconds']}s (avg {average:.1f}s over {len(history)})")
+        print(f"    Size                    {getattr(self, 'size', None) or 'none (fair share)'}")
+        if getattr(self, 'pgbouncer', False):
+            print(f"    PgBouncer pool size     {self.get_pool_size()} ({self.get_pool_size(rolling=True)} during a rolling restart)")
         if self.dependencies:
             print(f"    Dependencies            {', '.join(self.dependencies)}")
         if self.user:
@@ -0,0 +1,204 @@
+import os
+import time
+import pickle
+import subprocess
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = '/opt/odoo/'
+CGROUP_ROOT = '/sys/fs/cgroup/system.slice/'
+FILESTORE_TTL = 600
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# name: (type, help)
+METRICS = {
+    'odoo_instance_up': ('gauge', 'Whether the instance service is active'),
+    'odoo_instance_cpu_seconds_total': ('counter', 'CPU time used by the instance service'),
+    'odoo_instance_rss_bytes': ('gauge', 'Resident memory of the instance processes'),
+    'odoo_instance_processes': ('gauge', 'Number of processes of the instance (master, workers, cron, gevent)'),
+    'odoo_instance_connections': ('gauge', 'Established TCP connections on the instance ports'),
+    'odoo_instance_restarts_total': ('counter', 'Automatic restarts of the service done by systemd'),
+    'odoo_instance_restart_ready_seconds': ('gauge', 'Duration of the last restart until the instance was ready'),
+    'odoo_instance_last_update_timestamp_seconds': ('gauge', 'Time of the last Odoo code update'),
+    'odoo_instance_database_bytes': ('gauge', 'Size of the databases owned by the instance'),
+    'odoo_instance_database_connections': ('gauge', 'PostgreSQL connections of the instance'),
+    'odoo_instance_filestore_bytes': ('gauge', 'Size of the instance filestore (cached)'),
+}
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def get_service_properties(instance_names):
+    """ Read the state of every service with a single systemctl call """
+    properties = {}
+    if not instance_names:
+        return properties
+    output = subprocess.run(
+        ["systemctl", "show", "-p", "Id,ActiveState,NRestarts"] + [name + ".service" for name in instance_names],
+        stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8")
+    # One block of properties per unit, separated by an empty line
+    for block in output.strip().split("\n\n"):
+        values = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+        if "Id" in values:
+            properties[values["Id"][:-len(".service")]] = values
+    return properties
+
+
+def get_established_connections(ports):
+    """ Count established connections per local port in one pass over /proc/net """
+    connections = dict.fromkeys(ports, 0)
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        content = _read(path)
+        if not content:
+            continue
+        for line in content.splitlines()[1:]:
+            fields = line.split()
+            # State 01 is ESTABLISHED
+            if len(fields) < 4 or fields[3] != "01":
+                continue
+            port = int(fields[1].rsplit(":", 1)[1], 16)
+            if port in connections:
+                connections[port] += 1
+    return connections
+
+
+def get_cgroup_usage(instance_name):
+    """ Return the cpu seconds, resident memory and process count of a service """
+    cgroup = f"{CGROUP_ROOT}{instance_name}.service/"
+    cpu = None
+    cpu_stat = _read(cgroup + "cpu.stat")
+    if cpu_stat:
+        for line in cpu_stat.splitlines():
+            if line.startswith("usage_usec"):
+                cpu = int(line.split()[1]) / 1000000
+    pids = (_read(cgroup + "cgroup.procs") or "").split()
+    rss = 0
+    for pid in pids:
+        statm = _read(f"/proc/{pid}/statm")
+        if statm:
+            rss += int(statm.split()[1]) * PAGE_SIZE
+    return cpu, rss, len(pids)
+
+
+def get_database_usage():
+    """ Return the database size and connection count of every role with a single query """
+    query = (
+        "SELECT u.usename,"
+        " COALESCE((SELECT sum(pg_database_size(d.oid)) FROM pg_database d WHERE d.datdba = u.usesysid), 0),"
+        " (SELECT count(*) FROM pg_stat_activity a WHERE a.usename = u.usename)"
+        " FROM pg_user u"
+    )
+    output = subprocess.run(
+        ["sudo", "-u", "postgres", "psql", "-At", "-F", "\t", "-c", query],
+        stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8")
+    usage = {}
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) == 3:
+            usage[fields[0]] = (int(fields[1]), int(fields[2]))
+    return usage
+
+
+def get_directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def get_filestore_size(instance_name):
+    """ Return the filestore size, recomputed at most every FILESTORE_TTL seconds """
+    cache_path = f"{ROOT}{instance_name}/metrics_cache.pkl"
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+        if time.time() - cache['time'] < FILESTORE_TTL:
+            return cache['filestore_size']
+    size = get_directory_size(f"{ROOT}{instance_name}/.local/share/Odoo/filestore")
+    with open(cache_path, "wb") as f:
+        pickle.dump({'time': time.time(), 'filestore_size': size}, f)
+    return size
+
+
+def escape_label(value):
+    """ Escape a label value as the text exposition format requires """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def collect_metrics(instances):
+    """ Collect the metrics of all instances, return the text exposition format """
+    names = [instance.instance_name for instance in instances]
+    services = get_service_properties(names)
+    ports = []
+    for instance in instances:
+        ports += [int(instance.port), int(instance.longpolling_port)]
+    connections = get_established_connections(ports)
+    databases = get_database_usage()
+
+    samples = {name: [] for name in METRICS}
+    for instance in instances:
+        labels = ",".join(f'{key}="{escape_label(value)}"' for key, value in (
+            ("odoo_instance", instance.instance_name),
+            ("name", instance.name or ""),
+            ("version", instance.odoo_version),
+        ))
+        service = services.get(instance.instance_name, {})
+        cpu, rss, processes = get_cgroup_usage(instance.instance_name)
+        database_size, database_connections = databases.get(instance.instance_name, (0, 0))
+        history = getattr(instance, 'restart_history', [])
+
+        samples['odoo_instance_up'].append((labels, 1 if service.get("ActiveState") == "active" else 0))
+        if cpu is not None:
+            samples['odoo_instance_cpu_seconds_total'].append((labels, cpu))
+        samples['odoo_instance_rss_bytes'].append((labels, rss))
+        samples['odoo_instance_processes'].append((labels, processes))
+        samples['odoo_instance_connections'].append((labels, connections[int(instance.port)] + connections[int(instance.longpolling_port)]))
+        samples['odoo_instance_restarts_total'].append((labels, int(service.get("NRestarts") or 0)))
+        if history:
+            samples['odoo_instance_restart_ready_seconds'].append((labels, history[-1]['seconds']))
+        if instance.last_update_datetime:
+            samples['odoo_instance_last_update_timestamp_seconds'].append((labels, instance.last_update_datetime.timestamp()))
+        samples['odoo_instance_database_bytes'].append((labels, database_size))
+        samples['odoo_instance_database_connections'].append((labels, database_connections))
+        samples['odoo_instance_filestore_bytes'].append((labels, get_filestore_size(instance.instance_name)))
+
+    lines = []
+    for name, (type_, help_) in METRICS.items():
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {type_}")
+        for labels, value in samples[name]:
+            lines.append(f"{name}{{{labels}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(load_instances, port=9100, address="127.0.0.1"):
+    """ Serve the metrics over HTTP on /metrics, the instances are reloaded on each scrape """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = collect_metrics(load_instances()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    print(f"Serving metrics on http://{address}:{port}/metrics")
+    HTTPServer((address, port), MetricsHandler).serve_forever()
@@ -0,0 +1,87 @@
+import os
+import subprocess
+
+from src.utils import Bcolors
+
+TEMPLATE_ROOT = '/etc/odoo-server-manager/src/template/'
+PGBOUNCER_CONFIG = '/etc/pgbouncer/pgbouncer.ini'
+PGBOUNCER_USERLIST = '/etc/pgbouncer/userlist.txt'
+PGBOUNCER_HBA = '/etc/pgbouncer/pg_hba.conf'
+PGBOUNCER_PORT = 6432
+
+
+def install_pgbouncer():
+    """ Install pgbouncer if needed, return True if it was installed """
+    if os.path.exists("/etc/pgbouncer"):
+        return False
+    print("Installing pgbouncer...")
+    subprocess.run(["sudo", "apt-get", "install", "pgbouncer", "-y"])
+    subprocess.run(["sudo", "systemctl", "enable", "pgbouncer"])
+    return True
+
+
+def create_pgbouncer_config(instances):
+    """ Write the pgbouncer config and userlist for the instances using it, then reload pgbouncer """
+    instances = [instance for instance in instances if getattr(instance, 'pgbouncer', False)]
+    print("Creating pgbouncer config")
+    users = []
+    max_client_conn = 100
+    default_pool_size = 20
+    for instance in instances:
+        pool_size = instance.get_pool_size(rolling=True)
+        users.append(f"{instance.instance_name} = max_user_connections={pool_size}")
+        max_client_conn += pool_size
+        # Pools are per database and user, one database may use the whole budget of its instance
+        default_pool_size = max(default_pool_size, pool_size)
+    template = open(TEMPLATE_ROOT + "pgbouncer.ini", "r").read()
+    template = template.replace("{{users}}", "\n".join(users))
+    template = template.replace("{{pgbouncer_port}}", str(PGBOUNCER_PORT))
+    template = template.replace("{{max_client_conn}}", str(max_client_conn))
+    template = template.replace("{{default_pool_size}}", str(default_pool_size))
+    template = template.replace("{{auth_hba_file}}", PGBOUNCER_HBA)
+    with open(PGBOUNCER_CONFIG, "w") as f:
+        f.write(template)
+    # The admin console is only reachable as postgres on the unix socket, never over TCP
+    with open(PGBOUNCER_HBA, "w") as f:
+        f.write("local    pgbouncer    postgres    peer\n")
+        for instance in instances:
+            f.write(f"host    all    {instance.instance_name}    127.0.0.1/32    trust\n")
+    # Users still have to be listed, the methods above decide how they log in
+    with open(PGBOUNCER_USERLIST, "w") as f:
+        f.write('"postgres" ""\n')
+        for instance in instances:
+            f.write(f'"{instance.instance_name}" ""\n')
+    subprocess.run(["sudo", "systemctl", "reload-or-restart", "pgbouncer"])
+
+
+def get_pools():
+    """ Return the rows of SHOW POOLS from the pgbouncer admin console """
+    output = subprocess.run(
+        ["sudo", "-u", "postgres", "psql", "-h", "/var/run/postgresql", "-p", str(PGBOUNCER_PORT), "-A", "-F", "\t", "-c", "SHOW POOLS", "pgbouncer"],
+        stdout=subprocess.PIPE,
+    ).stdout.decode("utf-8").splitlines()
+    if not output:
+        return []
+    header = output[0].split("\t")
+    # The last line is the row count, e.g. (3 rows)
+    return [dict(zip(header, line.split("\t"))) for line in output[1:] if "\t" in line]
+
+
+def print_pool_report(instances):
+    """ Print the pool usage of each instance against its connection limit """
+    pools = get_pools()
+    for instance in instances:
+        if not getattr(instance, 'pgbouncer', False):
+            continue
+        rows = [row for row in pools if row.get("user") == instance.instance_name]
+        limit = instance.get_pool_size()
+        server = sum(int(row.get(column, 0)) for row in rows for column in ("sv_active", "sv_idle", "sv_used", "sv_tested", "sv_login"))
+        waiting = sum(int(row.get("cl_waiting", 0)) for row in rows)
+        max_wait = max([int(row.get("maxwait", 0)) for row in rows] or [0])
+        saturation = server / limit if limit else 0
+        color = Bcolors.FAIL if waiting else Bcolors.WARNING if saturation >= 0.8 else Bcolors.OKGREEN
+        print(color + f"{instance.name or instance.instance_name}" + Bcolors.ENDC)
+        print(f"    Server connections      {server}/{limit} ({saturation:.0%})")
+        print(f"    Waiting clients         {waiting} (max wait {max_wait}s)")
+        for row in rows:
+            print(f"    {row.get('database'):<24}active {row.get('cl_active')} client / {row.get('sv_active')} server, waiting {row.get('cl_waiting')}")
@@ -0,0 +1,368 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import queue
+import datetime
+import tarfile
+import threading
+import subprocess
+
+from src.instance import Instance, load_instance_data, check_port, get_release_sha256, get_release_build_path, keep_release_build, \
+    RELEASE_CACHE, TEMPLATE_ROOT, SIZE_CLASSES, DEFAULT_WARMUP_ROUTES
+from src.pgbouncer import install_pgbouncer
+from src.utils import Bcolors
+
+ROOT = '/opt/odoo/'
+CHUNK_SIZE = 16 * 1024 * 1024
+FILESTORE = '.local/share/Odoo/filestore'
+
+# Archive layout, in the order it is written
+META = 'instance.json'
+# The service and nginx site depend on the host (resources, shared nginx config), they are regenerated on import
+CONFIGS = {
+    'config/odoo.conf': '{ROOT}{instance_name}/odoo.conf',
+}
+RELEASE_PREFIX = 'release/'
+HOME_PREFIX = 'home/'
+DATABASE_PREFIX = 'databases/'
+
+# Instance attributes written in the metadata, everything else is rebuilt on the target.
+# The values end up in paths, configs and shell commands so they are validated on import.
+META_FIELDS = {
+    'instance_name': re.compile(r'^[0-9a-f]{32}$'),
+    'name': re.compile(r'^[^\x00-\x1f]*$'),
+    'odoo_version': re.compile(r'^\d+\.\d+$'),
+    'odoo_date': re.compile(r'^\d{8}$'),
+    'create_datetime': datetime.datetime,
+    'last_update_datetime': datetime.datetime,
+    'port': int,
+    'longpolling_port': int,
+    'server_name': re.compile(r'^[\w.* -]+$'),
+    'odoo_template': 'template',
+    'service_template': 'template',
+    'nginx_template': 'template',
+    # Anything pip accepts (specifiers, VCS URLs), they are passed without a shell, but no option
+    'dependencies': re.compile(r'^[^\s-][^\x00-\x1f]*$'),
+    'warmup_routes': re.compile(r'^/\S*$'),
+    'pgbouncer': bool,
+    'size': tuple(SIZE_CLASSES),
+}
+META_LISTS = {'dependencies', 'warmup_routes'}
+# Database names accepted by Odoo, they are passed to createdb and pg_restore
+DATABASE_PATTERN = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_.-]*$')
+META_OPTIONAL = {'name', 'odoo_date', 'last_update_datetime', 'server_name', 'size'}
+# Attributes missing from instances created by older versions
+META_DEFAULTS = {'warmup_routes': DEFAULT_WARMUP_ROUTES, 'pgbouncer': False}
+
+
+def log(message):
+    """ Messages go to stderr, stdout may be the archive """
+    print(message, file=sys.stderr)
+
+
+def open_output(path):
+    """ Open the archive output, with - the real stdout is kept for the archive and fd 1 goes to stderr """
+    if path != "-":
+        return open(path, "wb")
+    output = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    return output
+
+
+def open_input(path):
+    if path == "-":
+        return sys.stdin.buffer
+    return open(path, "rb")
+
+
+def get_databases(instance_name):
+    """ Return the databases owned by the instance role """
+    query = f"SELECT d.datname FROM pg_database d JOIN pg_user u ON d.datdba = u.usesysid WHERE u.usename = '{instance_name}'"
+    output = subprocess.run(["sudo", "-u", "postgres", "psql", "-At", "-c", query], stdout=subprocess.PIPE).stdout.decode("utf-8")
+    return [line for line in output.splitlines() if line]
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _dump_database(database, chunks, semaphore):
+    """ Run pg_dump and push its output as (database, index, data) chunks, None data when done """
+    with semaphore:
+        log(f"Dumping database {database}")
+        process = subprocess.Popen(["sudo", "-u", "postgres", "pg_dump", "-Fc", database], stdout=subprocess.PIPE)
+        index = 0
+        while True:
+            data = process.stdout.read(CHUNK_SIZE)
+            if not data:
+                break
+            chunks.put((database, index, data))
+            index += 1
+        if process.wait() != 0:
+            log(Bcolors.FAIL + f"pg_dump of {database} failed" + Bcolors.ENDC)
+        chunks.put((database, index, None))
+
+
+def dump_metadata(instance):
+    """ Return the whitelisted instance attributes as JSON, datetimes as ISO strings """
+    data = {}
+    for field in META_FIELDS:
+        value = getattr(instance, field, META_DEFAULTS.get(field))
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        data[field] = value
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
+def _check_value(field, rule, value):
+    if rule is int:
+        return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 65536
+    if rule is bool:
+        return isinstance(value, bool)
+    if rule is datetime.datetime:
+        try:
+            datetime.datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+    if rule == 'template':
+        return isinstance(value, str) and os.path.basename(value) == value and os.path.isfile(TEMPLATE_ROOT + value)
+    if isinstance(rule, tuple):
+        return value in rule
+    return isinstance(value, str) and bool(rule.match(value))
+
+
+def load_metadata(data):
+    """ Rebuild an Instance from the metadata written by dump_metadata, raise ValueError if a value is invalid """
+    try:
+        data = json.loads(data)
+    except ValueError:
+        raise ValueError("Invalid archive, the instance metadata is not valid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("Invalid archive, the instance metadata must be a mapping")
+    instance = Instance.__new__(Instance)
+    for field, rule in META_FIELDS.items():
+        value = data.get(field)
+        if value in (None, "") and field in META_OPTIONAL:
+            value = None
+        elif field in META_LISTS:
+            if not isinstance(value, list) or not all(_check_value(field, rule, item) for item in value):
+                raise ValueError(f"Invalid archive, bad value for {field}")
+        elif not _check_value(field, rule, value):
+            raise ValueError(f"Invalid archive, bad value for {field}")
+        if rule is datetime.datetime and value is not None:
+            value = datetime.datetime.fromisoformat(value)
+        setattr(instance, field, value)
+    instance.user = []
+    instance.restart_history = []
+    return instance
+
+
+def check_exportable(instance):
+    """ Raise ValueError if the import would refuse the metadata or the databases of the instance """
+    try:
+        load_metadata(dump_metadata(instance))
+    except ValueError as e:
+        raise ValueError(f"The instance cannot be exported, the import would fail: {e}")
+    for database in get_databases(instance.instance_name):
+        if not DATABASE_PATTERN.match(database):
+            raise ValueError(f"Database {database} cannot be exported, its name is not accepted by Odoo")
+
+
+def get_release_source(instance, with_source=True):
+    """ Return the release zip to put in the archive, None to leave it out, raise ValueError if it is missing
+
+    Latest releases are always sent: the target cannot download the build the instance runs.
+    The build is looked up under its hash in the cache, then under the release name in the cache
+    and where instances used to download it, checking its content against the recorded hash.
+    """
+    release_name = instance.get_release_name()
+    if not with_source and instance.odoo_date:
+        return None
+    if not with_source:
+        log(Bcolors.WARNING + f"{release_name} cannot be downloaded again, it is sent anyway" + Bcolors.ENDC)
+    expected = getattr(instance, 'release_sha256', None)
+    if not instance.odoo_date and expected and os.path.exists(get_release_build_path(instance.odoo_version, expected)):
+        return get_release_build_path(instance.odoo_version, expected)
+    for path in (RELEASE_CACHE + release_name, f"{ROOT}{instance.instance_name}/{release_name}"):
+        if not os.path.exists(path):
+            continue
+        if instance.odoo_date:
+            return path
+        if expected is None:
+            log(Bcolors.WARNING + f"The build of {release_name} cannot be checked, update the instance to record it" + Bcolors.ENDC)
+            return path
+        if get_release_sha256(path) == expected:
+            return path
+    raise ValueError(f"No copy of {release_name} matching the build the instance runs was found")
+
+
+def export_instance(instance, output, jobs=None, release_path=None):
+    """ Write the instance (metadata, odoo.conf, release, custom addons, filestore and databases) as a tar stream
+
+    The databases are dumped in parallel while the files are written, their output is
+    interleaved in the archive as numbered chunks so nothing is buffered on disk.
+    """
+    name = instance.instance_name
+    if instance.user:
+        log(Bcolors.WARNING + f"Users are not exported, add them again on the target: {', '.join(user.username for user in instance.user)}" + Bcolors.ENDC)
+    databases = get_databases(name)
+    chunks = queue.Queue(maxsize=8)
+    semaphore = threading.Semaphore(jobs or os.cpu_count() or 1)
+    for database in databases:
+        threading.Thread(target=_dump_database, args=(database, chunks, semaphore), daemon=True).start()
+
+    with tarfile.open(fileobj=output, mode="w|") as tar:
+        _add_bytes(tar, META, dump_metadata(instance))
+        for arcname, path in CONFIGS.items():
+            path = path.format(ROOT=ROOT, instance_name=name)
+            if os.path.exists(path):
+                tar.add(path, arcname=arcname)
+        if release_path:
+            log(f"Adding release {instance.get_release_name()}")
+            tar.add(release_path, arcname=RELEASE_PREFIX + instance.get_release_name())
+        for directory in ("custom_addons", FILESTORE):
+            if os.path.exists(f"{ROOT}{name}/{directory}"):
+                log(f"Adding {directory}")
+                tar.add(f"{ROOT}{name}/{directory}", arcname=HOME_PREFIX + directory)
+
+        remaining = len(databases)
+        while remaining:
+            database, index, data = chunks.get()
+            if data is None:
+                remaining -= 1
+                continue
+            _add_bytes(tar, f"{DATABASE_PREFIX}{database}/{index:06d}", data)
+    log(Bcolors.OKGREEN + f"Exported {name} ({len(databases)} databases)" + Bcolors.ENDC)
+
+
+class DatabaseRestorer:
+    """ Restore a database from chunks fed while the archive is read, in a thread of its own """
+
+    def __init__(self, instance_name, database):
+        self.database = database
+        self.chunks = queue.Queue(maxsize=4)
+        log(f"Restoring database {database}")
+        subprocess.run(["sudo", "-u", instance_name, "createdb", database])
+        self.process = subprocess.Popen(["sudo", "-u", instance_name, "pg_restore", "--no-owner", "-d", database], stdin=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._feed, daemon=True)
+        self.thread.start()
+
+    def _feed(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                break
+            self.process.stdin.write(data)
+        self.process.stdin.close()
+
+    def write(self, data):
+        self.chunks.put(data)
+
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+        return self.process.wait() == 0
+
+
+def _get_home_path(instance_name, member_name):
+    """ Path of an archive member inside the instance home, None if it would escape it """
+    relative = os.path.normpath(member_name[len(HOME_PREFIX):])
+    if relative.startswith("..") or os.path.isabs(relative):
+        return None
+    return f"{ROOT}{instance_name}/{relative}"
+
+
+def import_instance(input_):
+    """ Recreate an instance from a tar stream written by export_instance """
+    restorers = {}
+    instance = None
+    with tarfile.open(fileobj=input_, mode="r|*") as tar:
+        for member in tar:
+            if member.name == META:
+                instance = load_metadata(tar.extractfile(member).read())
+                _create_imported_instance(instance)
+                continue
+            if instance is None:
+                raise ValueError("Invalid archive, the instance metadata must come first")
+            name = instance.instance_name
+            if member.name in CONFIGS:
+                with open(CONFIGS[member.name].format(ROOT=ROOT, instance_name=name), "wb") as f:
+                    f.write(tar.extractfile(member).read())
+            elif member.name.startswith(RELEASE_PREFIX):
+                # Only the release of the instance, a crafted name could replace another cached release
+                if member.name != RELEASE_PREFIX + instance.get_release_name():
+                    raise ValueError(f"Invalid archive, unexpected release {member.name}")
+                release_path = RELEASE_CACHE + os.path.basename(member.name)
+                # Dated releases never change, a cached latest one may be another build
+                if instance.odoo_date and os.path.exists(release_path):
+                    log(f"Release {os.path.basename(member.name)} already cached")
+                    continue
+                subprocess.run(["sudo", "mkdir", "-p", RELEASE_CACHE])
+                if os.path.exists(release_path):
+                    keep_release_build(instance.odoo_version, release_path)
+                with open(release_path + ".part", "wb") as f:
+                    source = tar.extractfile(member)
+                    while data := source.read(CHUNK_SIZE):
+                        f.write(data)
+                os.rename(release_path + ".part", release_path)
+            elif member.name.startswith(HOME_PREFIX):
+                path = _get_home_path(name, member.name)
+                if path is None:
+                    log(Bcolors.WARNING + f"Skipping {member.name}" + Bcolors.ENDC)
+                elif member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                elif member.isfile():
+                    with open(path, "wb") as f:
+                        source = tar.extractfile(member)
+                        while data := source.read(CHUNK_SIZE):
+                            f.write(data)
+            elif member.name.startswith(DATABASE_PREFIX):
+                database = member.name[len(DATABASE_PREFIX):].split("/")[0]
+                if not DATABASE_PATTERN.match(database):
+                    raise ValueError(f"Invalid archive, bad database name {database}")
+                if database not in restorers:
+                    restorers[database] = DatabaseRestorer(name, database)
+                restorers[database].write(tar.extractfile(member).read())
+
+    if instance is None:
+        raise ValueError("Invalid archive, no instance metadata")
+    for database, restorer in restorers.items():
+        if not restorer.close():
+            log(Bcolors.WARNING + f"pg_restore of {database} reported errors" + Bcolors.ENDC)
+    _finish_imported_instance(instance)
+    return instance
+
+
+def _create_imported_instance(instance):
+    """ Create the user, folders and PostgreSQL role of an imported instance """
+    if load_instance_data(instance.instance_name):
+        raise ValueError(f"Instance {instance.instance_name} already exists")
+    if not check_port(instance.port) or not check_port(instance.longpolling_port):
+        raise ValueError("Port is not free")
+    log(f"Importing {instance.instance_name}")
+    if instance.pgbouncer:
+        install_pgbouncer()
+    instance._create_user()
+    instance._create_folder_structure()
+    instance._create_postgresql_user()
+    instance._create_venv()
+
+
+def _finish_imported_instance(instance):
+    """ Install the source, then create the service and site once everything is extracted """
+    instance.chown()
+    instance.update_odoo_code(download=False)
+    if instance.pgbouncer:
+        instance._create_pgbouncer_config()
+    instance._create_service_config()
+    subprocess.run(["sudo", "systemctl", "daemon-reload"])
+    instance._create_ngnix_config()
+    instance.save()
+    instance.restart()
@@ -33,3 +33,12 @@ def get_postgres_version() -> str:
     """ Get the postgres version """
     version = subprocess.run(["psql", "--version"], stdout=subprocess.PIPE).stdout.decode("utf-8").split(" ")[2].split("\n")[0]
     return version.split(".")[0]
+
+
+def get_total_memory() -> int:
+    """ Get the total memory of the host in bytes """
+    with open("/proc/meminfo", "r") as f:
+        for line in f.readlines():
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return 0